@@ -0,0 +1,63 @@
+import contextlib
+import io
+import sys
+import traceback
+
+# Heavy libraries generated code usually needs, preloaded by the forkserver so
+# each run forks with them already imported
+PREWARM_MODULES = (
+    "json",
+    "re",
+    "io",
+    "numpy",
+    "pandas",
+    "duckdb",
+    "matplotlib.pyplot",
+    "requests",
+    # Generated code loads the saved data files with pd.read_feather
+    "pyarrow.feather",
+)
+
+# Cap on buffered output per run; generated code can print whole DataFrames or plots
+MAX_OUTPUT_CHARS = 16 * 1024 * 1024
+
+
+class _BoundedWriter(io.StringIO):
+    """StringIO that silently drops anything written past a size limit"""
+
+    def __init__(self, limit=MAX_OUTPUT_CHARS):
+        super().__init__()
+        self._room = limit
+
+    def write(self, s):
+        if self._room > 0:
+            super().write(s[: self._room])
+            self._room -= len(s)
+        return len(s)
+
+
+def run_user_code(code_text: str) -> tuple:
+    """Run generated code in this process, returning (returncode, stdout, stderr)"""
+    stdout, stderr = _BoundedWriter(), _BoundedWriter()
+    returncode = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            code = compile(code_text, "chatgpt_code.py", "exec")
+            exec(code, {"__name__": "__main__", "__file__": "chatgpt_code.py"})
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+    # Only failed runs need stderr, so skip shipping it back otherwise
+    return returncode, stdout.getvalue(), stderr.getvalue() if returncode else ""
+
+
+def run_to_pipe(code_text: str, conn):
+    """Sandbox child entry point: run the code and send the result back over conn"""
+    conn.send(run_user_code(code_text))
+    conn.close()
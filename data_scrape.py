@@ -16,7 +16,7 @@ load_dotenv()
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
 gemini_api = os.getenv("gemini_api")
 
-async def ping_gemini(question_text, relevant_context="", max_tries=3):
+async def ping_gemini(question_text, relevant_context="", max_tries=3, client=None):
     tries = 0
     while tries < max_tries:
         try:
@@ -41,23 +41,27 @@ async def ping_gemini(question_text, relevant_context="", max_tries=3):
                     }
                 ]
             }
-            async with httpx.AsyncClient(timeout=60) as client:
-                response = await client.post(GEMINI_API_URL, headers=headers, json=payload)
-                response.raise_for_status()
-                
-                # Debug: Print response content
-                response_text = response.text
-                print(f"Gemini response length: {len(response_text)}")
-                
-                if not response_text.strip():
-                    raise Exception("Empty response from Gemini API")
-                
-                try:
-                    return response.json()
-                except json.JSONDecodeError as json_error:
-                    print(f"JSON decode error: {json_error}")
-                    print(f"Response content: {response_text[:500]}...")
-                    raise Exception(f"Invalid JSON response: {json_error}")
+            # Reuse the caller's pooled client when one is injected
+            if client is not None:
+                response = await client.post(GEMINI_API_URL, headers=headers, json=payload, timeout=60)
+            else:
+                async with httpx.AsyncClient(timeout=60) as own_client:
+                    response = await own_client.post(GEMINI_API_URL, headers=headers, json=payload)
+            response.raise_for_status()
+            
+            # Debug: Print response content
+            response_text = response.text
+            print(f"Gemini response length: {len(response_text)}")
+            
+            if not response_text.strip():
+                raise Exception("Empty response from Gemini API")
+            
+            try:
+                return response.json()
+            except json.JSONDecodeError as json_error:
+                print(f"JSON decode error: {json_error}")
+                print(f"Response content: {response_text[:500]}...")
+                raise Exception(f"Invalid JSON response: {json_error}")
                     
         except Exception as e:
             print(f"Error during Gemini call: {e}")
@@ -67,7 +71,8 @@ async def ping_gemini(question_text, relevant_context="", max_tries=3):
 class NumericFieldFormatter:
     """Handles identification and cleaning of numeric fields in DataFrames"""
     
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self.http_client = http_client
         self.currency_symbols = ['$', '€', '£', '¥', '₹', '₽', 'R$', 'A$', 'C$', '₦', '₨']
         self.percentage_indicators = ['%']
     
@@ -151,7 +156,7 @@ class NumericFieldFormatter:
         - ["2023-01-01", "12:30:00"] → dates/times (already excluded)
         """
         
-        response = await ping_gemini(identification_prompt, "You are a data analysis expert specializing in numeric data identification. Return only valid JSON.")
+        response = await ping_gemini(identification_prompt, "You are a data analysis expert specializing in numeric data identification. Return only valid JSON.", client=self.http_client)
         
         try:
             # Check if response has error
@@ -483,6 +488,9 @@ class NumericFieldFormatter:
 class WebScraper:
     """Handles web scraping functionality"""
     
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self.http_client = http_client
+    
     async def fetch_webpage(self, url: str) -> str:
         """Fetch webpage content using Playwright with stealth mode"""
         stealth = Stealth()
@@ -576,7 +584,8 @@ class WebScraper:
         
         response = await ping_gemini(
             analysis_prompt, 
-            "You are an HTML parsing expert. Analyze the structure and provide specific extraction guidance. Return only valid JSON."
+            "You are an HTML parsing expert. Analyze the structure and provide specific extraction guidance. Return only valid JSON.",
+            client=self.http_client
         )
         
         try:
@@ -705,7 +714,7 @@ class WebScraper:
         """
         
         try:
-            response = await ping_gemini(selection_prompt, "You are a data analysis expert. Select the most relevant table. Return only valid JSON.")
+            response = await ping_gemini(selection_prompt, "You are a data analysis expert. Select the most relevant table. Return only valid JSON.", client=self.http_client)
             
             if "error" not in response and "candidates" in response:
                 response_text = response["candidates"][0]["content"]["parts"][0]["text"]
@@ -1094,9 +1103,9 @@ class WebScraper:
 class ImprovedWebScraper:
     """Main class that coordinates web scraping and numeric formatting"""
     
-    def __init__(self):
-        self.numeric_formatter = NumericFieldFormatter()
-        self.web_scraper = WebScraper()
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self.numeric_formatter = NumericFieldFormatter(http_client)
+        self.web_scraper = WebScraper(http_client)
     
     async def extract_data(self, source_config: Dict[str, Any]) -> Dict[str, Any]:
         """Main method to extract data from web sources"""